@@ -5,7 +5,6 @@
 import docker
 import logging
 import shutil
-from copy import deepcopy
 from pathlib import Path
 from docker.models.containers import Container
 from templates import TEMPLATES
@@ -21,6 +20,7 @@ from warnet.utils import (
 
 CONTAINER_PREFIX_BITCOIND = "tank"
 CONTAINER_PREFIX_PROMETHEUS = "prometheus_exporter"
+TANK_INDEX_LABEL = "tank_index"
 logger = logging.getLogger("tank")
 
 
@@ -58,7 +58,7 @@ class Tank:
         )
 
     @classmethod
-    def from_graph_node(cls, index, warnet):
+    def from_graph_node(cls, index, node, warnet):
         assert index is not None
 
         self = cls()
@@ -66,7 +66,6 @@ class Tank:
         self.docker_network = warnet.docker_network
         self.bitcoin_network = warnet.bitcoin_network
         self.index = int(index)
-        node = warnet.graph.nodes[index]
         if "version" in node:
             if not "/" and "#" in self.version:
                 if node["version"] not in SUPPORTED_TAGS:
@@ -78,29 +77,17 @@ class Tank:
             self.conf = node["bitcoin_config"]
         if "tc_netem" in node:
             self.netem = node["tc_netem"]
-        with open(self.warnet.fork_observer_config, "a") as f:
-            f.write(
-                f"""
-    [[networks.nodes]]
-    id = {self.index}
-    name = "Node {self.index}"
-    description = "Warnet tank {self.index}"
-    rpc_host = "{self.ipv4}"
-    rpc_port = {self.rpc_port}
-    rpc_user = "{self.rpc_user}"
-    rpc_password = "{self.rpc_password}"
-"""
-            )
         self.config_dir = self.warnet.config_dir / str(self.suffix)
         self.config_dir.mkdir(parents=True, exist_ok=True)
         self.write_torrc()
         return self
 
     @classmethod
-    def from_docker_env(cls, network, index):
+    def from_docker_env(cls, network, index, container=None):
         self = cls()
         self.index = int(index)
         self.docker_network = network
+        self._container = container
         self._ipv4 = self.container.attrs["NetworkSettings"]["Networks"][
             self.docker_network
         ]["IPAddress"]
@@ -171,7 +158,9 @@ class Tank:
             )
 
     def write_bitcoin_conf(self, base_bitcoin_conf):
-        conf = deepcopy(base_bitcoin_conf)
+        # Copy-on-write: only the section we extend is copied from the base
+        conf = dict(base_bitcoin_conf)
+        section = list(conf.get(self.bitcoin_network, ()))
         options = self.conf.split(",")
         for option in options:
             option = option.strip()
@@ -180,11 +169,12 @@ class Tank:
                     key, value = option.split("=")
                 else:
                     key, value = option, "1"
-                conf[self.bitcoin_network].append((key, value))
+                section.append((key, value))
 
-        conf[self.bitcoin_network].append(("rpcuser", self.rpc_user))
-        conf[self.bitcoin_network].append(("rpcpassword", self.rpc_password))
-        conf[self.bitcoin_network].append(("rpcport", self.rpc_port))
+        section.append(("rpcuser", self.rpc_user))
+        section.append(("rpcpassword", self.rpc_password))
+        section.append(("rpcport", self.rpc_port))
+        conf[self.bitcoin_network] = section
 
         conf_file = dump_bitcoin_conf(conf)
         path = self.config_dir / f"bitcoin.conf"
@@ -200,10 +190,10 @@ class Tank:
         shutil.copyfile(src_tor_conf_file, dest_path)
         self.torrc_file = dest_path
 
-    def add_services(self, services):
+    def get_services(self):
         assert self.index is not None
         assert self.conf_file is not None
-        services[self.container_name] = {}
+        services = {self.container_name: {}}
 
         # Setup bitcoind, either release binary or build from source
         if "/" and "#" in self.version:
@@ -243,7 +233,7 @@ class Tank:
                     }
                 },
                 "extra_hosts": [f"dummySeed.invalid:{DNS_IP_ADDR}"], # hack to trick regtest into doing dns lookups
-                "labels": {"warnet": "tank"},
+                "labels": {"warnet": "tank", TANK_INDEX_LABEL: str(self.index)},
                 "privileged": True,
                 "cap_add": ["NET_ADMIN", "NET_RAW"],
                 "dns": [DNS_IP_ADDR],
@@ -271,6 +261,19 @@ class Tank:
             "ports": [f"{8335 + self.index}:9332"],
             "networks": [self.docker_network],
         }
+        return services
+
+    def fork_observer_entry(self) -> str:
+        return f"""
+    [[networks.nodes]]
+    id = {self.index}
+    name = "Node {self.index}"
+    description = "Warnet tank {self.index}"
+    rpc_host = "{self.ipv4}"
+    rpc_port = {self.rpc_port}
+    rpc_user = "{self.rpc_user}"
+    rpc_password = "{self.rpc_password}"
+"""
 
     def add_scrapers(self, scrapers):
         scrapers.append(
@@ -7,10 +7,12 @@ import random
 import re
 import subprocess
 import sys
+import tarfile
 import time
+import xml.etree.ElementTree as ET
 from io import BytesIO
 from pathlib import Path
-from typing import Dict
+from typing import Dict, List, Tuple
 
 from test_framework.p2p import MESSAGEMAP
 from test_framework.messages import ser_uint256
@@ -32,6 +34,15 @@ SUPPORTED_TAGS = [
     "0.15.2",
 ]
 RUNNING_PROC_FILE = "running_scenarios.dat"
+GRAPHML_NS = "{http://graphml.graphdrawing.org/xmlns}"
+GRAPHML_TYPES = {
+    "boolean": lambda v: v.strip().lower() in ("true", "1"),
+    "int": int,
+    "long": int,
+    "float": float,
+    "double": float,
+    "string": str,
+}
 
 
 def exponential_backoff(max_retries=5, base_delay=1, max_delay=32):
@@ -225,6 +236,63 @@ def dump_bitcoin_conf(conf_dict):
     return "\n".join(result) + "\n"
 
 
+def fast_read_graphml(path) -> Tuple[Dict[int, Dict], List[Tuple[int, int]]]:
+    """
+    Stream a GraphML file and return only what Warnet needs from it.
+
+    Each node and edge element is detached from its parent <graph> as soon as
+    it has been processed, so the parsed tree never grows with graph size;
+    only the returned nodes and edges do.
+
+    Args:
+    - path: Path to the GraphML file.
+
+    Returns:
+    - tuple: (nodes, edges) where nodes maps integer node IDs to their data
+             attributes (in file order) and edges is a list of integer
+             (src, dst) tuples.
+    """
+    keys = {}
+    nodes = {}
+    edges = []
+    graphs = []
+    for event, elem in ET.iterparse(str(path), events=("start", "end")):
+        if elem.tag == f"{GRAPHML_NS}graph":
+            if event == "start":
+                graphs.append(elem)
+            else:
+                graphs.pop()
+        elif event == "start":
+            continue
+        elif elem.tag == f"{GRAPHML_NS}key":
+            # Like networkx, <default> values are not applied to nodes
+            keys[elem.get("id")] = (
+                elem.get("attr.name", elem.get("id")),
+                GRAPHML_TYPES.get(elem.get("attr.type", "string"), str),
+            )
+        elif elem.tag == f"{GRAPHML_NS}node":
+            attrs = {}
+            for data in elem.iterfind(f"{GRAPHML_NS}data"):
+                name, cast = keys[data.get("key")]
+                attrs[name] = cast(data.text or "")
+            nodes[int(elem.get("id"))] = attrs
+            graphs[-1].remove(elem)
+        elif elem.tag == f"{GRAPHML_NS}edge":
+            edges.append((int(elem.get("source")), int(elem.get("target"))))
+            graphs[-1].remove(elem)
+
+    # Unlike networkx, which silently creates a node for any edge endpoint
+    # without a <node> element, reject such graphs: Warnet would otherwise
+    # build too few tanks and only fail once connecting edges.
+    for src, dst in edges:
+        missing = [n for n in (src, dst) if n not in nodes]
+        if missing:
+            raise Exception(
+                f"Edge ({src}, {dst}) in {path} references undefined node(s) {missing}"
+            )
+    return nodes, edges
+
+
 def to_jsonable(obj):
     HASH_INTS = [
         "blockhash",
@@ -339,6 +407,21 @@ def parse_raw_messages(blob, outbound):
     return messages
 
 
+def tar_single_file(name: str, content: bytes, mode: int = 0o644) -> bytes:
+    """
+    Build an in-memory tar archive holding a single file, suitable for
+    docker's put_archive().
+    """
+    info = tarfile.TarInfo(name=name)
+    info.size = len(content)
+    info.mode = mode
+    info.mtime = int(time.time())
+    buf = BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        tar.addfile(info, BytesIO(content))
+    return buf.getvalue()
+
+
 def gen_config_dir(network: str) -> Path:
     """
     Determine a config dir based on network name
@@ -2,15 +2,20 @@
   Warnet is the top-level class for a simulated network.
 """
 
+import concurrent.futures
 import docker
+import functools
 import logging
 import networkx
+import os
 import shutil
 import subprocess
 import yaml
+from collections import defaultdict
 from pathlib import Path
+from types import MappingProxyType
 from templates import TEMPLATES
-from typing import List
+from typing import Dict, List, Tuple
 
 from services.prometheus import Prometheus
 from services.node_exporter import NodeExporter
@@ -19,8 +24,20 @@ from services.tor import Tor
 from services.fork_observer import ForkObserver
 # from services.fluentd import FLUENT_CONF, Fluentd, FLUENT_IP
 from services.dns_seed import DnsSeed, ZONE_FILE_NAME, DNS_SEED_NAME
-from warnet.tank import Tank
-from warnet.utils import parse_bitcoin_conf, gen_config_dir, bubble_exception_str, version_cmp_ge
+from warnet.tank import Tank, CONTAINER_PREFIX_BITCOIND, TANK_INDEX_LABEL
+from warnet.utils import (
+    parse_bitcoin_conf,
+    gen_config_dir,
+    bubble_exception_str,
+    version_cmp_ge,
+    fast_read_graphml,
+    tar_single_file,
+)
+
+try:
+    from yaml import CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeDumper as YamlDumper
 
 logger = logging.getLogger("warnet")
 FO_CONF_NAME = "fork_observer_config.toml"
@@ -28,36 +45,50 @@ logging.getLogger("docker.utils.config").setLevel(logging.WARNING)
 logging.getLogger("docker.auth").setLevel(logging.WARNING)
 
 
+# Templates are read once per process rather than once per Warnet
+_FO_CONF_TEMPLATE = (TEMPLATES / FO_CONF_NAME).read_text()
+_ZONE_TEMPLATE = (TEMPLATES / ZONE_FILE_NAME).read_text().rstrip()
+# Read-only view; sections are tuples so tanks must copy before extending them
+_BASE_BITCOIN_CONF = MappingProxyType(
+    {
+        section: tuple(values)
+        for section, values in parse_bitcoin_conf(
+            (TEMPLATES / "bitcoin.conf").read_text()
+        ).items()
+    }
+)
+
+
 class Warnet:
     def __init__(self, config_dir):
         self.config_dir: Path = config_dir
-        self.config_dir.mkdir(parents=True, exist_ok=True)
         self.docker = docker.from_env()
         self.bitcoin_network: str = "regtest"
         self.docker_network: str = "warnet"
         self.subnet: str = "100.0.0.0/8"
-        self.graph = None
+        # Graph kept as plain node attributes and edge tuples; the networkx
+        # object is only built on demand by the `graph` property.
+        self._nodes: Dict[int, Dict] = {}
+        self._edges: List[Tuple[int, int]] = []
+        self._graph = None
         self.graph_name = "graph.graphml"
         self.tanks: List[Tank] = []
-        self.fork_observer_config = self.config_dir / FO_CONF_NAME
-        logger.info(
-            f"copying config {TEMPLATES / FO_CONF_NAME} to {self.fork_observer_config}"
-        )
-        shutil.copy(TEMPLATES / FO_CONF_NAME, self.fork_observer_config)
+        self._zone_bytes = None
         # shutil.copy(TEMPLATES / FLUENT_CONF, self.config_dir)
 
     def __str__(self) -> str:
         template = "\t%-8.8s%-25.24s%-25.24s%-25.24s%-18.18s\n"
-        tanks_str = template % ("Index", "Version", "Conf", "Netem", "IPv4")
-        for tank in self.tanks:
-            tanks_str += template % (tank.index, tank.version, tank.conf, tank.netem, tank.ipv4)
+        tanks_str = template % ("Index", "Version", "Conf", "Netem", "IPv4") + "".join(
+            template % (tank.index, tank.version, tank.conf, tank.netem, tank.ipv4)
+            for tank in self.tanks
+        )
         return (
             f"Warnet:\n"
             f"\tTemp Directory: {self.config_dir}\n"
             f"\tBitcoin Network: {self.bitcoin_network}\n"
             f"\tDocker Network: {self.docker_network}\n"
             f"\tSubnet: {self.subnet}\n"
-            f"\tGraph: {self.graph}\n"
+            f"\tGraph: {len(self._nodes)} nodes, {len(self._edges)} edges\n"
             f"Tanks:\n{tanks_str}"
         )
 
@@ -69,10 +100,14 @@ class Warnet:
         self = cls(config_dir)
         destination = self.config_dir / self.graph_name
         destination.parent.mkdir(parents=True, exist_ok=True)
-        shutil.copy(graph_file, destination)
+        # A real copy, not a link: the stashed graph is what later reloads of
+        # this network read, so it must not follow edits to graph_file.
+        # copyfile uses the kernel's zero-copy path on Linux.
+        shutil.copyfile(graph_file, destination)
         self.docker_network = network
-        self.graph = networkx.read_graphml(graph_file, node_type=int)
+        self._nodes, self._edges = fast_read_graphml(graph_file)
         self.tanks_from_graph()
+        self.write_fork_observer_config()
         logger.info(f"Created Warnet using directory {self.config_dir}")
         return self
 
@@ -80,7 +115,9 @@ class Warnet:
     @bubble_exception_str
     def from_graph(cls, graph):
         self = cls(Path())
-        self.graph = graph
+        self._nodes = {int(node): data for node, data in graph.nodes(data=True)}
+        self._edges = [(int(src), int(dst)) for src, dst in graph.edges()]
+        self._graph = graph
         self.tanks_from_graph()
         logger.info(f"Created Warnet using directory {self.config_dir}")
         return self
@@ -92,9 +129,7 @@ class Warnet:
     ):
         self = cls(config_dir)
         self.config_dir = gen_config_dir(network)
-        self.graph = networkx.read_graphml(
-            Path(self.config_dir / self.graph_name), node_type=int
-        )
+        self._nodes, self._edges = fast_read_graphml(self.config_dir / self.graph_name)
         if tanks:
             self.tanks_from_graph()
         return self
@@ -104,20 +139,55 @@ class Warnet:
     def from_docker_env(cls, network_name):
         config_dir = gen_config_dir(network_name)
         self = cls(config_dir)
-        self.graph = networkx.read_graphml(
-            Path(self.config_dir / self.graph_name), node_type=int
-        )
+        self._nodes, self._edges = fast_read_graphml(self.config_dir / self.graph_name)
         self.docker_network = network_name
-        index = 0
-        while index <= 999999:
-            try:
-                self.tanks.append(Tank.from_docker_env(self.docker_network, index))
-                index = index + 1
-            except:
-                assert index == len(self.tanks)
-                break
+        # A sparse listing already carries the labels, names and network
+        # settings each Tank needs, so no per-container inspect is required.
+        # Stopped tanks are included so they still occupy their index.
+        containers = self.docker.containers.list(
+            all=True,
+            sparse=True,
+            filters={"network": self.docker_network, "label": "warnet=tank"},
+        )
+        name_prefix = f"/{self.docker_network}_{CONTAINER_PREFIX_BITCOIND}_"
+        indexed = []
+        for container in containers:
+            labels = container.attrs.get("Labels") or {}
+            if TANK_INDEX_LABEL in labels:
+                index = int(labels[TANK_INDEX_LABEL])
+            else:
+                # Containers created before tanks were labelled with their index
+                name = next(
+                    n for n in container.attrs["Names"] if n.startswith(name_prefix)
+                )
+                index = int(name[len(name_prefix) :])
+            indexed.append((index, container))
+        indexed.sort(key=lambda item: item[0])
+        # Callers index self.tanks by tank index, so a gap would silently
+        # shift every later tank onto the wrong position
+        indices = [index for index, _ in indexed]
+        if indices != list(range(len(indices))):
+            raise Exception(
+                f"Tank indices in network '{self.docker_network}' must be consecutive integers starting at 0 (got {indices})"
+            )
+        self.tanks = [
+            Tank.from_docker_env(self.docker_network, index, container)
+            for index, container in indexed
+        ]
         return self
 
+    @property
+    def graph(self) -> networkx.DiGraph:
+        if self._graph is None:
+            self._graph = networkx.DiGraph()
+            self._graph.add_nodes_from(self._nodes.items())
+            self._graph.add_edges_from(self._edges)
+        return self._graph
+
+    @property
+    def fork_observer_config(self) -> Path:
+        return self.config_dir / FO_CONF_NAME
+
     @property
     @bubble_exception_str
     def zone_file_path(self):
@@ -125,43 +195,62 @@ class Warnet:
 
     @bubble_exception_str
     def tanks_from_graph(self):
-        for node_id in self.graph.nodes():
-            if int(node_id) != len(self.tanks):
-                raise Exception(
-                    f"Node ID in graph must be incrementing integers (got '{node_id}', expected '{len(self.tanks)}')"
-                )
-            self.tanks.append(Tank.from_graph_node(node_id, self))
+        node_ids = sorted(self._nodes)
+        if node_ids != list(range(len(node_ids))):
+            raise Exception(
+                f"Node IDs in graph must be consecutive integers starting at 0 (got {node_ids})"
+            )
+        self.tanks = [
+            Tank.from_graph_node(node_id, self._nodes[node_id], self)
+            for node_id in node_ids
+        ]
         logger.info(f"Imported {len(self.tanks)} tanks from graph")
 
     @bubble_exception_str
     def write_bitcoin_confs(self):
-        with open(TEMPLATES / "bitcoin.conf", "r") as file:
-            text = file.read()
-        base_bitcoin_conf = parse_bitcoin_conf(text)
-        for tank in self.tanks:
-            tank.write_bitcoin_conf(base_bitcoin_conf)
+        if not self.tanks:
+            return
+        write_conf = functools.partial(
+            Tank.write_bitcoin_conf, base_bitcoin_conf=_BASE_BITCOIN_CONF
+        )
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(32, len(self.tanks))
+        ) as executor:
+            # Consume the iterator so exceptions from workers are raised here
+            list(executor.map(write_conf, self.tanks))
 
     @bubble_exception_str
-    def apply_network_conditions(self):
-        for tank in self.tanks:
-            tank.apply_network_conditions()
+    def write_fork_observer_config(self):
+        """
+        Write the fork-observer config from the template plus one entry per
+        tank. Only done when a warnet is created, so reloading an existing
+        network never touches the config mounted into its fork-observer.
+        """
+        content = _FO_CONF_TEMPLATE + "".join(
+            tank.fork_observer_entry() for tank in self.tanks
+        )
+        self.fork_observer_config.write_text(content)
+        logger.info(f"Wrote file: {self.fork_observer_config}")
 
     @bubble_exception_str
-    def generate_zone_file_from_tanks(self):
-        records_list = [
-            f"x9.dummySeed.invalid.     300 IN  A   {tank.ipv4}" for tank in self.tanks
-        ]
-        content = []
-        with open(str(TEMPLATES / ZONE_FILE_NAME), "r") as f:
-            content = [line.rstrip() for line in f]
+    def apply_network_conditions(self):
+        if not self.tanks:
+            return
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(32, len(self.tanks))
+        ) as executor:
+            list(executor.map(Tank.apply_network_conditions, self.tanks))
 
+    @bubble_exception_str
+    def generate_zone_file_from_tanks(self) -> bytes:
         # TODO: Really we should also read active SOA value from dns-seed, and increment from there
 
-        content.extend(records_list)
-        # Join the content into a single string and escape single quotes for echoing
-        content_str = "\n".join(content).replace("'", "'\\''")
-        with open(self.config_dir / ZONE_FILE_NAME, "w") as f:
-            f.write(content_str)
+        records = "\n".join(
+            f"x9.dummySeed.invalid.     300 IN  A   {tank.ipv4}" for tank in self.tanks
+        )
+        self._zone_bytes = f"{_ZONE_TEMPLATE}\n{records}\n".encode()
+        self.zone_file_path.write_bytes(self._zone_bytes)
+        return self._zone_bytes
 
     @bubble_exception_str
     def apply_zone_file(self):
@@ -170,13 +259,15 @@ class Warnet:
         """
         seeder = self.docker.containers.get(f"{self.docker_network}_{DNS_SEED_NAME}")
 
-        # Read the content from the generated zone file
-        with open(self.config_dir / ZONE_FILE_NAME, "r") as f:
-            content_str = f.read().replace("'", "'\\''")
+        # Reuse the zone generated by this Warnet, only falling back to disk
+        # when it was generated elsewhere
+        content = self._zone_bytes
+        if content is None:
+            content = self.zone_file_path.read_bytes()
 
-        # Overwrite all existing content
-        result = seeder.exec_run(
-            f"sh -c 'echo \"{content_str}\" > /etc/bind/invalid.zone'"
+        # Overwrite all existing content by streaming the file into the container
+        result = seeder.put_archive(
+            "/etc/bind", tar_single_file(ZONE_FILE_NAME, content)
         )
         logger.debug(f"result of updating {ZONE_FILE_NAME}: {result}")
 
@@ -185,70 +276,93 @@ class Warnet:
 
     @bubble_exception_str
     def connect_edges(self):
-        for edge in self.graph.edges():
-            (src, dst) = edge
+        # Group edges by source so each tank's connections run back-to-back,
+        # while the (latency bound) docker exec calls for different tanks
+        # run concurrently.
+        edges_by_src = defaultdict(list)
+        for src, dst in self._edges:
+            edges_by_src[src].append(dst)
+        if not edges_by_src:
+            return
+
+        ips = [tank.ipv4 for tank in self.tanks]
+
+        def connect_src(src, dsts):
             src_tank = self.tanks[src]
-            dst_ip = self.tanks[dst].ipv4
+            dst_ips = " ".join(ips[dst] for dst in dsts)
             # <= 20.2 doesn't have addpeeraddress
             res = version_cmp_ge(src_tank.version, "0.21.0")
             if res:
-                logger.info(f"Using `addpeeraddress` to connect tanks {src} to {dst}")
-                cmd = f"bitcoin-cli addpeeraddress {dst_ip} 18444"
+                logger.info(f"Using `addpeeraddress` to connect tank {src} to {dsts}")
+                peer_cmd = "bitcoin-cli addpeeraddress $ip 18444"
             else:
-                logger.info(f"Using `addnode` to connect tanks {src} to {dst}")
-                cmd = f'bitcoin-cli addnode "{dst_ip}:18444" onetry'
+                logger.info(f"Using `addnode` to connect tank {src} to {dsts}")
+                peer_cmd = 'bitcoin-cli addnode "$ip:18444" onetry'
+            # One exec per source tank instead of one per edge
+            cmd = f"sh -c 'set -e; for ip in {dst_ips}; do {peer_cmd}; done'"
             src_tank.exec(cmd=cmd, user="bitcoin")
 
-    @bubble_exception_str
-    def docker_compose_build_up(self):
-        command = ["docker-compose", "-p", self.docker_network, "up", "-d", "--build"]
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(64, len(edges_by_src))
+        ) as executor:
+            futures = [
+                executor.submit(connect_src, src, dsts)
+                for src, dsts in edges_by_src.items()
+            ]
+            for future in futures:
+                future.result()
+
+    def _run_compose(self, args: List[str], env=None):
+        command = ["docker-compose"] + args
         try:
             with subprocess.Popen(
                 command,
                 cwd=str(self.config_dir),
+                env=env,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.STDOUT,
+                bufsize=-1,
+                text=True,
+                encoding="utf-8",
+                errors="replace",
             ) as process:
                 for line in process.stdout:
-                    logger.info(line.decode().rstrip())
+                    logger.info(line.rstrip())
+                returncode = process.wait()
         except Exception as e:
             logger.error(
                 f"An error occurred while executing `{' '.join(command)}` in {self.config_dir}: {e}"
             )
+            return
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command)
+
+    @bubble_exception_str
+    def docker_compose_build_up(self):
+        # Build all tank images concurrently with BuildKit, then start the
+        # containers without triggering another (serial) build.
+        # Bound concurrent builds by CPU count; docker-compose rejects
+        # COMPOSE_PARALLEL_LIMIT values below 2.
+        parallel = max(2, min(len(self.tanks), os.cpu_count() or 1))
+        build_env = dict(
+            os.environ,
+            DOCKER_BUILDKIT="1",
+            COMPOSE_DOCKER_CLI_BUILD="1",
+            COMPOSE_PARALLEL_LIMIT=str(parallel),
+        )
+        self._run_compose(
+            ["-p", self.docker_network, "build", "--parallel"], env=build_env
+        )
+        # Container start is I/O bound, so keep compose's default limit for it
+        self._run_compose(["-p", self.docker_network, "up", "-d", "--no-build"])
 
     @bubble_exception_str
     def docker_compose_up(self):
-        command = ["docker-compose", "-p", self.docker_network, "up", "-d"]
-        try:
-            with subprocess.Popen(
-                command,
-                cwd=str(self.config_dir),
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-            ) as process:
-                for line in process.stdout:
-                    logger.info(line.decode().rstrip())
-        except Exception as e:
-            logger.error(
-                f"An error occurred while executing `{' '.join(command)}` in {self.config_dir}: {e}"
-            )
+        self._run_compose(["-p", self.docker_network, "up", "-d"])
 
     @bubble_exception_str
     def docker_compose_down(self):
-        command = ["docker-compose", "down"]
-        try:
-            with subprocess.Popen(
-                command,
-                cwd=str(self.config_dir),
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-            ) as process:
-                for line in process.stdout:
-                    logger.info(line.decode().rstrip())
-        except Exception as e:
-            logger.error(
-                f"An error occurred while executing `{' '.join(command)}` in {self.config_dir}: {e}"
-            )
+        self._run_compose(["down"])
 
     @bubble_exception_str
     def write_docker_compose(self, dns=True):
@@ -261,13 +375,14 @@ class Warnet:
                 }
             },
             "volumes": {"grafana-storage": None},
-            "services": {},
+            # Each tank provides its bitcoind and exporter services
+            "services": {
+                name: service
+                for tank in self.tanks
+                for name, service in tank.get_services().items()
+            },
         }
 
-        # Pass services object to each tank so they can add whatever they need.
-        for tank in self.tanks:
-            tank.add_services(compose["services"])
-
         # Initialize services and add them to the compose
         services = [
             Prometheus(self.docker_network, self.config_dir),
@@ -286,8 +401,15 @@ class Warnet:
 
         docker_compose_path = self.config_dir / "docker-compose.yml"
         try:
-            with open(docker_compose_path, "w") as file:
-                yaml.dump(compose, file)
+            # libyaml writes straight into a 64 KiB buffered file
+            with open(docker_compose_path, "w", buffering=1 << 16) as file:
+                yaml.dump(
+                    compose,
+                    file,
+                    Dumper=YamlDumper,
+                    default_flow_style=False,
+                    sort_keys=False,
+                )
             logger.info(f"Wrote file: {docker_compose_path}")
         except Exception as e:
             logger.error(
@@ -323,7 +445,13 @@ class Warnet:
         prometheus_path = self.config_dir / "prometheus.yml"
         try:
             with open(prometheus_path, "w") as file:
-                yaml.dump(config, file)
+                yaml.dump(
+                    config,
+                    file,
+                    Dumper=YamlDumper,
+                    default_flow_style=False,
+                    sort_keys=False,
+                )
             logger.info(f"Wrote file: {prometheus_path}")
         except Exception as e:
             logger.error(f"An error occurred while writing to {prometheus_path}: {e}")